@@ -1,16 +1,98 @@
-import collections
 import datetime
-import itertools
 import logging
 import random
 import re
 import sqlite3
+import time
 
 from rtmbot.core import Plugin
 
 from .komida_parser import KomidaUpdate
 
 
+_log = logging.getLogger(__name__)
+
+# triggers for menu requests on public channels (case insensitive)
+_TRIGGER_RE = re.compile(r'komidabot|^l+u+n+c+h+!+$', re.IGNORECASE)
+
+# texts by which each campus can be mentioned and the corresponding campus acronyms
+_CAMPUS_TEXTS = {'cde': 'cde', 'drie eiken': 'cde', 'cgb': 'cgb', 'groenenborger': 'cgb',
+                 'cmi': 'cmi', 'middelheim': 'cmi', 'cst': 'cst', 'stad': 'cst', 'city': 'cst'}
+_CAMPUS_RE = re.compile('|'.join(map(re.escape, _CAMPUS_TEXTS)))
+# temporal nouns and their offset in days from today
+_RELATIVE_DAYS = (('today', 0), ('tomorrow', 1), ('yesterday', -1))
+# days of the week and their weekday number
+_WEEKDAYS = (('monday', 0), ('tuesday', 1), ('wednesday', 2), ('thursday', 3), ('friday', 4), ('saturday', 5),
+             ('sunday', 6))
+
+# emojis to indicate the menu types
+_MENU_EMOJIS = {'soup': ':tea:', 'vegetarian': ':tomato:', 'meat': ':poultry_leg:', 'grill': ':meat_on_bone:',
+                'pasta': ':spaghetti:'}
+# formatting of the menu attachments
+_CAMPUS_COLORS = {'cde': 'good', 'cgb': 'warning', 'cmi': 'danger', 'cst': '#439FE0'}
+_TITLE_FMT = 'Menu komida {} on {}'
+_MENU_ITEM_FMT = '{} {} (€{:.2f} / €{:.2f})'
+
+# appearance of the komidabot's Slack messages
+_POST_DEFAULTS = {'username': 'komidabot', 'icon_emoji': ':fork_and_knife:'}
+# gifs to accompany the message that no menu could be found
+_FAIL_GIFS = ('https://giphy.com/gifs/monkey-laptop-baboon-xTiTnJ3BooiDs8dL7W',
+              'https://giphy.com/gifs/office-space-jBBRs81dGWHIY',
+              'https://giphy.com/gifs/computer-Zw133sEVc0WXK',
+              'https://giphy.com/gifs/computer-D8kdCAJIoSQ6I',
+              'https://giphy.com/gifs/richard-ayoade-it-crowd-maurice-moss-dbtDDSvWErdf2')
+
+# persistent connection to the menu database, shared between menu requests
+_conn = None
+# menu queries by number of requested (dates, campuses), identical SQL hits the connection's statement cache
+_menu_sql = {}
+# recently retrieved menus by (campuses, dates), cleared whenever the menu is updated
+_menu_cache = {}
+# number of seconds a retrieved menu is served from the cache
+MENU_CACHE_TIMEOUT = 60
+
+
+def get_connection():
+    """
+    Retrieve the persistent connection to the menu database.
+
+    The connection is only opened upon first use to avoid creating an empty database before it has been initialized.
+
+    Returns:
+        An autocommit `sqlite3.Connection` to the menu database.
+    """
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect('menu.db', check_same_thread=False, isolation_level=None)
+    return _conn
+
+
+def get_menu_sql(num_dates, num_campuses):
+    """
+    Retrieve the query to select the menu for the given number of dates and campuses.
+
+    Args:
+        num_dates: The number of dates for which the menu is retrieved.
+        num_campuses: The number of campuses for which the menu is retrieved.
+
+    Returns:
+        The SQL query with a parameter placeholder for each of the dates followed by each of the campuses.
+    """
+    key = (num_dates, num_campuses)
+    if key not in _menu_sql:
+        _menu_sql[key] = ('SELECT date, campus, type, item, price_student, price_staff FROM menu '
+                          'WHERE date IN ({}) AND campus IN ({}) ORDER BY date, campus'
+                          .format(','.join('?' * num_dates), ','.join('?' * num_campuses)))
+    return _menu_sql[key]
+
+
+def invalidate_menu_cache():
+    """
+    Remove all previously retrieved menus from the cache.
+    """
+    _menu_cache.clear()
+
+
 def get_campus(text):
     """
     Check which campus is mentioned in the given text.
@@ -24,14 +106,11 @@ def get_campus(text):
         A list with acronyms for all UAntwerp campuses that were mentioned in the text. Defaults to CMI if no campus is
         explicitly mentioned.
     """
-    campus_options = [('cde', ['cde', 'drie eiken']), ('cgb', ['cgb', 'groenenborger']),
-                      ('cmi', ['cmi', 'middelheim']), ('cst', ['cst', 'stad', 'city'])]
-
-    campus = sorted([c_code for c_code, c_texts in campus_options if any(c_text in text for c_text in c_texts)])
+    campus = sorted({_CAMPUS_TEXTS[c_text] for c_text in _CAMPUS_RE.findall(text)})
     return campus if len(campus) > 0 else ['cmi']
 
 
-def get_date(text):
+def get_date(text, today=None):
     """
     Check which date is mentioned in the given text.
 
@@ -39,18 +118,19 @@ def get_date(text):
 
     Args:
         text: The text in which the occurrence of dates is checked.
+        today: The current date at midnight. Defaults to the actual current date if not given.
 
     Returns:
         A list with `datetime` objects for all of the dates that were mentioned in the text. Defaults to today if no
         date is explicitly mentioned.
     """
-    today = datetime.datetime.today().replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
-    date_options = [('today', 0), ('tomorrow', 1), ('yesterday', -1), ('monday', 0 - today.weekday()),
-                    ('tuesday', 1 - today.weekday()), ('wednesday', 2 - today.weekday()),
-                    ('thursday', 3 - today.weekday()), ('friday', 4 - today.weekday()),
-                    ('saturday', 5 - today.weekday()), ('sunday', 6 - today.weekday())]
+    if today is None:
+        today = datetime.datetime.today().replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    weekday = today.weekday()
 
-    dates = sorted([today + datetime.timedelta(days=date_diff) for day, date_diff in date_options if day in text])
+    date_diffs = [date_diff for day, date_diff in _RELATIVE_DAYS if day in text]
+    date_diffs.extend(day_num - weekday for day, day_num in _WEEKDAYS if day in text)
+    dates = sorted([today + datetime.timedelta(days=date_diff) for date_diff in date_diffs])
     return dates if len(dates) > 0 else [today]
 
 
@@ -58,23 +138,43 @@ def get_menu(campuses, dates):
     """
     Retrieve the menu on the given dates for the given campuses from the database.
 
+    All requested dates and campuses are retrieved using a single query, regardless of how many are requested. Recently
+    retrieved menus are served from the cache without querying the database.
+
     Args:
         campuses: The campuses for which the menu is retrieved.
         dates: The dates for which the menu is retrieved.
 
     Returns:
-        A nested dictionary with as keys the requested dates and campuses, and for each of these possibilities a
-        dictionary with as key the type of menu item and as values the menu content and the prices for students and
-        staff.
+        A nested dictionary with as keys the requested dates and campuses for which a menu was found, and for each of
+        these possibilities a dictionary with as key the type of menu item and as values the menu content and the
+        prices for students and staff.
     """
-    conn = sqlite3.connect('menu.db')
-    c = conn.cursor()
+    # nothing to retrieve
+    if not campuses or not dates:
+        return {}
+
+    # serve repeated requests from the cache
+    key = (tuple(campuses), tuple(dates))
+    if key in _menu_cache:
+        timestamp, menu = _menu_cache[key]
+        if time.monotonic() - timestamp < MENU_CACHE_TIMEOUT:
+            return menu
+
+    c = get_connection().cursor()
+
+    # query the dates in the textual format in which the default sqlite3 adapter stored them, and map the results back
+    # to the requested `datetime` objects
+    dates_stored = {date.isoformat(' '): date for date in dates}
+
+    # retrieve all requested dates and campuses at once
+    c.execute(get_menu_sql(len(dates_stored), len(campuses)), (*dates_stored, *campuses))
 
-    menu = collections.defaultdict(dict)
-    for date, campus in itertools.product(dates, campuses):
-        c.execute('SELECT type, item, price_student, price_staff FROM menu WHERE date = ? AND campus = ?', (date, campus))
-        for menu_type, menu_item, price_student, price_staff in c.fetchall():
-            menu[(date, campus)][menu_type] = (menu_item, price_student, price_staff)
+    menu = {}
+    for date, campus, menu_type, menu_item, price_student, price_staff in c.fetchall():
+        menu.setdefault((dates_stored[date], campus), {})[menu_type] = (menu_item, price_student, price_staff)
+
+    _menu_cache[key] = (time.monotonic(), menu)
 
     return menu
 
@@ -89,12 +189,10 @@ def create_attachments(menu):
     Returns:
         A list of individual menus as a dictionary formatted to be used as a Slack attachment.
     """
-    campus_colors = {'cde': 'good', 'cgb': 'warning', 'cmi': 'danger', 'cst': '#439FE0'}
-
     attachments = []
     for (date, campus), menu_items in menu.items():
-        attachments.append({'title': 'Menu komida {} on {}'.format(campus.upper(), date.strftime('%A %d %B')),
-                            'color': campus_colors[campus], 'text': format_menu(menu_items)})
+        attachments.append({'title': _TITLE_FMT.format(campus.upper(), date.strftime('%A %d %B')),
+                            'color': _CAMPUS_COLORS[campus], 'text': format_menu(menu_items)})
 
     return attachments
 
@@ -110,19 +208,17 @@ def format_menu(menu):
     Returns:
         The nicely format menu including emojis to indicate the menu types.
     """
-    message = []
-    if 'soup' in menu:
-        message.append(':tea: {} (€{:.2f} / €{:.2f})'.format(*menu['soup']))
-    if 'vegetarian' in menu:
-        message.append(':tomato: {} (€{:.2f} / €{:.2f})'.format(*menu['vegetarian']))
-    if 'meat' in menu:
-        message.append(':poultry_leg: {} (€{:.2f} / €{:.2f})'.format(*menu['meat']))
-    for key in menu.keys():
-        if 'grill' in key:
-            message.append(':meat_on_bone: {} (€{:.2f} / €{:.2f})'.format(*menu[key]))
-    for key in menu.keys():
-        if 'pasta' in key:
-            message.append(':spaghetti: {} (€{:.2f} / €{:.2f})'.format(*menu[key]))
+    message = [_MENU_ITEM_FMT.format(_MENU_EMOJIS[menu_type], *menu[menu_type])
+               for menu_type in ('soup', 'vegetarian', 'meat') if menu_type in menu]
+    # there can be multiple grill and pasta items, which are listed after the daily menu items
+    grill, pasta = [], []
+    for menu_type, menu_item in menu.items():
+        if 'grill' in menu_type:
+            grill.append(_MENU_ITEM_FMT.format(_MENU_EMOJIS['grill'], *menu_item))
+        elif 'pasta' in menu_type:
+            pasta.append(_MENU_ITEM_FMT.format(_MENU_EMOJIS['pasta'], *menu_item))
+    message.extend(grill)
+    message.extend(pasta)
 
     return '\n'.join(message)
 
@@ -133,12 +229,12 @@ class KomidaPlugin(Plugin):
         """
         Initialize the KomidaBot Slack plugin.
 
-        Includes a timed job to update the menu every hour.
+        Includes a timed job to update the menu every two hours, which clears the cached menus after each update.
         """
         super().__init__(name, slack_client, plugin_config)
 
         # schedule an update of the menu every two hours
-        self.update = KomidaUpdate(7200)
+        self.update = KomidaUpdate(7200, on_update=invalidate_menu_cache)
         self.jobs.append(self.update)
 
     def process_message(self, data):
@@ -158,31 +254,32 @@ class KomidaPlugin(Plugin):
         # ignore messages by the bot itself or from other bots
         if data.get('username') == 'komidabot' or 'bot' in data.get('subtype', []):
             return
-        # ignore messages that don't contain the text as we expect it to
-        if 'text' not in data:
+        # ignore messages that don't contain the text and channel as we expect it to
+        channel = data.get('channel') or ''
+        if 'text' not in data or not channel:
             return
         else:
-            text = data['text'].lower()
+            text = data['text']
         # ignore messages on public channels that don't contain the trigger word (lunch)
-        if data.get('channel').startswith('C') and not\
-                ('komidabot' in text or re.search('^l+u+n+c+h+!+$', text) is not None):
+        # check the original text to avoid creating a lowercase copy of every message
+        if channel[:1] == 'C' and _TRIGGER_RE.search(text) is None:
             return
+        text = text.lower()
 
         # parse the campus(es) and date(s) from the request
+        today = datetime.datetime.today().replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
         campuses = get_campus(text)
-        dates = get_date(text)
+        dates = get_date(text, today)
 
         # get the requested menus
         menus = get_menu(campuses, dates)
         # force a menu update if nothing could be found initially
-        if len(menus) == 0:
+        if len(menus) == 0 and campuses and dates:
             try:
-                logging.debug('No menu found, updating...')
+                _log.debug('No menu found, updating...')
 
-                response = self.slack_client.api_call('chat.postMessage', channel=data['channel'],
-                                                      text="I don't have the menu for {} on {}. Let me see if I can find it online...".format(
-                                                          ', '.join(campuses).upper(), ', '.join([d.strftime('%A %d %B') for d in dates])),
-                                                      username='komidabot', icon_emoji=':fork_and_knife:')
+                response = self._post(data['channel'], "I don't have the menu for {} on {}. Let me see if I can find it online...".format(
+                    ', '.join(campuses).upper(), ', '.join([d.strftime('%A %d %B') for d in dates])))
                 if not response['ok']:
                     self.process_error(data['channel'], response['error'])
 
@@ -190,23 +287,15 @@ class KomidaPlugin(Plugin):
                 self.update.run(self.slack_client)
                 menus = get_menu(campuses, dates)
             except Exception as e:
-                logging.exception('Problem while updating the menu: {}'.format(e))
+                _log.exception('Problem while updating the menu: %s', e)
 
         # reply with the menu
         if len(menus) > 0:
-            response = self.slack_client.api_call('chat.postMessage', channel=data['channel'], text='*LUNCH!*',
-                                                  attachments=create_attachments(menus),
-                                                  username='komidabot', icon_emoji=':fork_and_knife:')
+            response = self._post(data['channel'], '*LUNCH!*', attachments=create_attachments(menus))
         # or send a final message that no menu could be found
         else:
-            fail_gifs = ['https://giphy.com/gifs/monkey-laptop-baboon-xTiTnJ3BooiDs8dL7W',
-                         'https://giphy.com/gifs/office-space-jBBRs81dGWHIY',
-                         'https://giphy.com/gifs/computer-Zw133sEVc0WXK',
-                         'https://giphy.com/gifs/computer-D8kdCAJIoSQ6I',
-                         'https://giphy.com/gifs/richard-ayoade-it-crowd-maurice-moss-dbtDDSvWErdf2']
-            response = self.slack_client.api_call('chat.postMessage', channel=data['channel'],
-                                                  text="_COMPUTER SAYS NO._ I'm sorry, no menu has been found.\n{}".format(random.choice(fail_gifs)),
-                                                  username='komidabot', icon_emoji=':fork_and_knife:')
+            response = self._post(data['channel'], "_COMPUTER SAYS NO._ I'm sorry, no menu has been found.\n{}".format(
+                random.choice(_FAIL_GIFS)))
 
         # check if the menu was correctly sent
         if not response['ok']:
@@ -223,13 +312,25 @@ class KomidaPlugin(Plugin):
             reason: The error reason.
         """
         # log the error
-        logging.error('Failed to post to Slack: {}'.format(reason))
+        _log.error('Failed to post to Slack: %s', reason)
 
         # try to send an error message upon a failure
-        response = self.slack_client.api_call('chat.postMessage', channel=channel,
-                                              text="I'm sorry, I can't tell you the menu. Error status: {}".format(reason),
-                                              username='komidabot', icon_emoji=':fork_and_knife:')
+        response = self._post(channel, "I'm sorry, I can't tell you the menu. Error status: {}".format(reason))
 
         # check the error status of this message but don't try to resend
         if not response['ok']:
-            logging.error('Failed to post to Slack: {}'.format(response['error']))
+            _log.error('Failed to post to Slack: %s', response['error'])
+
+    def _post(self, channel, text, **kwargs):
+        """
+        Post a message as the komidabot to a Slack channel.
+
+        Args:
+            channel: The channel to which the message is posted.
+            text: The text of the message.
+            **kwargs: Additional arguments for the `chat.postMessage` API method.
+
+        Returns:
+            The Slack API response.
+        """
+        return self.slack_client.api_call('chat.postMessage', channel=channel, text=text, **_POST_DEFAULTS, **kwargs)
@@ -230,6 +230,18 @@ def init_database():
 
 class KomidaUpdate(Job):
 
+    def __init__(self, interval, on_update=None):
+        """
+        Initialize the menu update job.
+
+        Args:
+            interval: The number of seconds between subsequent menu updates.
+            on_update: Optional callable without arguments that is invoked after each menu update.
+        """
+        super().__init__(interval)
+
+        self.on_update = on_update
+
     def run(self, slack_client):
         # create the database if needed
         if not os.path.exists('menu.db'):
@@ -238,5 +250,9 @@ class KomidaUpdate(Job):
         # update the menu
         update_menus()
 
+        # notify that the menu has changed
+        if self.on_update is not None:
+            self.on_update()
+
         # expects an iterable
         return []